@@ -15,31 +15,114 @@
 from __future__ import print_function
 from builtins import range, zip
 import random
+from math import sin, cos
 import numpy as np
-from copy import deepcopy
 from scipy.ndimage import map_coordinates
 from scipy.ndimage.filters import gaussian_filter, gaussian_gradient_magnitude
 from scipy.ndimage.morphology import grey_dilation
 from skimage.transform import resize
-from scipy.ndimage.measurements import label as lb
+from scipy.ndimage.measurements import label as lb, find_objects
 
+try:
+    import cc3d
+except ImportError:
+    cc3d = None
 
-def generate_elastic_transform_coordinates(shape, alpha, sigma):
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+# scipy border modes that torch.nn.functional.grid_sample (with align_corners=True) reproduces. For 'constant',
+# points outside the image are set to cval afterwards
+TORCH_PADDING_MODES = {'nearest': 'border', 'constant': 'border', 'mirror': 'reflection'}
+
+
+def interpolate_img_batched(img, coords, order=3, mode='nearest', cval=0.0, is_seg=False, backend='auto'):
+    """
+    Same as interpolate_img, but for a whole batch at once. With the torch backend the entire batch is interpolated
+    with a single torch.nn.functional.grid_sample call (on the GPU if one is available) instead of looping over
+    samples and channels.
+
+    :param img: b x c x X x Y(x Z)
+    :param coords: n_dim x x x y(x z) (shared by all samples) or b x n_dim x x x y(x z) (one per sample)
+    :param backend: 'scipy' (map_coordinates, see interpolate_img), 'torch' or 'auto'. 'auto' uses torch if it is
+    installed and a GPU is available. Everything grid_sample cannot do like map_coordinates (order > 1, is_seg,
+    border modes other than nearest, mirror and constant) always uses scipy
+    :return: b x c x x x y(x z), same dtype as img
+    """
+    n_dim = len(img.shape) - 2
+    if coords.ndim == n_dim + 1:
+        coords = np.broadcast_to(coords, (img.shape[0],) + coords.shape)
+
+    if backend == 'auto':
+        backend = 'torch' if torch is not None and torch.cuda.is_available() else 'scipy'
+    if backend == 'torch':
+        if torch is None:
+            raise RuntimeError("backend='torch' requires pytorch to be installed")
+        if order > 1 or is_seg or mode not in TORCH_PADDING_MODES:
+            backend = 'scipy'
+    elif backend != 'scipy':
+        raise ValueError("backend must be one of 'auto', 'scipy' or 'torch', got %s" % str(backend))
+
+    if backend == 'scipy':
+        result = np.zeros(img.shape[:2] + coords.shape[2:], dtype=img.dtype)
+        for b in range(img.shape[0]):
+            for c in range(img.shape[1]):
+                result[b, c] = interpolate_img(img[b, c], coords[b], order, mode, cval, is_seg)
+        return result
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # grid_sample expects the coordinates normalized to [-1, 1] and in the last axis, in reversed axis order (x is the
+    # last axis of img)
+    img_shape = np.array(img.shape[2:], dtype=np.float32).reshape((1, -1) + (1,) * n_dim)
+    grid = coords / np.maximum(img_shape - 1, 1) * 2 - 1
+    grid = np.ascontiguousarray(np.moveaxis(grid[:, ::-1], 1, -1), dtype=np.float32)
+    result = torch.nn.functional.grid_sample(torch.from_numpy(np.ascontiguousarray(img, dtype=np.float32)).to(device),
+                                             torch.from_numpy(grid).to(device),
+                                             mode='nearest' if order == 0 else 'bilinear',
+                                             padding_mode=TORCH_PADDING_MODES[mode], align_corners=True)
+    result = result.cpu().numpy()
+    if mode == 'constant':
+        outside = np.any((coords < 0) | (coords > img_shape - 1), axis=1)
+        result[np.broadcast_to(outside[:, None], result.shape)] = cval
+    return result.astype(img.dtype, copy=False)
+
+
+def generate_uniform_noise(shape, out=None):
+    """
+    Uniform noise in [-1, 1) as float32. This uses numpy's (PCG64) Generator which is a lot faster than the legacy
+    np.random functions. The Generator is seeded from np.random, so results are still reproducible with np.random.seed
+    and every worker of the MultiThreadedAugmenter gets its own noise.
+    :param shape:
+    :param out: optional float32 array of the given shape the noise is written to (avoids allocating a new array)
+    :return:
+    """
+    rng = np.random.default_rng(np.random.randint(0, 2 ** 32, dtype=np.int64))
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    rng.random(out.shape, dtype=np.float32, out=out)
+    out *= 2
+    out -= 1
+    return out
+
+
+def generate_elastic_transform_coordinates(shape, alpha, sigma, dtype=np.float32):
     n_dim = len(shape)
-    offsets = []
-    for _ in range(n_dim):
-        offsets.append(gaussian_filter((np.random.random(shape) * 2 - 1), sigma, mode="constant", cval=0) * alpha)
-    tmp = tuple([np.arange(i) for i in shape])
-    coords = np.meshgrid(*tmp, indexing='ij')
-    indices = [np.reshape(i + j, (-1, 1)) for i, j in zip(offsets, coords)]
-    return indices
-
-
-def create_zero_centered_coordinate_mesh(shape):
-    tmp = tuple([np.arange(i) for i in shape])
-    coords = np.array(np.meshgrid(*tmp, indexing='ij')).astype(float)
-    for d in range(len(shape)):
-        coords[d] -= ((np.array(shape).astype(float) - 1) / 2.)[d]
+    # indices[d] is the (prod(shape), 1) coordinate column of axis d
+    indices = np.empty((n_dim,) + tuple(shape), dtype=dtype)
+    rand = generate_uniform_noise(indices.shape)
+    for d in range(n_dim):
+        gaussian_filter(rand[d], sigma, output=indices[d], mode="constant", cval=0)
+    indices *= alpha
+    indices += np.indices(shape)
+    return indices.reshape((n_dim, -1, 1))
+
+
+def create_zero_centered_coordinate_mesh(shape, dtype=np.float32):
+    coords = np.indices(shape, dtype=dtype)
+    coords -= ((np.array(shape, dtype=dtype) - 1) / 2.).reshape((-1,) + (1,) * len(shape))
     return coords
 
 
@@ -50,47 +133,87 @@ def convert_seg_image_to_one_hot_encoding(image, classes=None):
     '''
     if classes is None:
         classes = np.unique(image)
-    out_image = np.zeros([len(classes)]+list(image.shape), dtype=image.dtype)
-    for i, c in enumerate(classes):
-        out_image[i][image == c] = 1
+    classes = np.asarray(classes).reshape((-1,) + (1,) * image.ndim)
+    out_image = np.empty((len(classes),) + image.shape, dtype=image.dtype)
+    # compare in chunks of classes so that the temporary boolean array stays small if there are many classes
+    chunk_size = 16
+    for i in range(0, len(classes), chunk_size):
+        out_image[i:i + chunk_size] = image[None] == classes[i:i + chunk_size]
     return out_image
 
 
-def elastic_deform_coordinates(coordinates, alpha, sigma):
+def elastic_deform_coordinates(coordinates, alpha, sigma, out=None):
+    """
+    :param coordinates: (n_dim, x, y(, z)) coordinates to deform
+    :param out: optional array to write the deformed coordinates to, can be coordinates itself for an in-place update.
+    Callers processing many samples of the same shape can reuse it to avoid allocating a new array per sample
+    :return:
+    """
     n_dim = len(coordinates)
-    offsets = []
-    for _ in range(n_dim):
-        offsets.append(
-            gaussian_filter((np.random.random(coordinates.shape[1:]) * 2 - 1), sigma, mode="constant", cval=0) * alpha)
-    offsets = np.array(offsets)
-    indices = offsets + coordinates
-    return indices
+    if out is None:
+        # float32 coordinates stay float32
+        out = np.empty(coordinates.shape, dtype=np.result_type(coordinates.dtype, np.float32))
+    rand = generate_uniform_noise(coordinates.shape)
+    offsets = np.empty(coordinates.shape[1:], dtype=np.float32)
+    for d in range(n_dim):
+        gaussian_filter(rand[d], sigma, output=offsets, mode="constant", cval=0)
+        offsets *= alpha
+        np.add(coordinates[d], offsets, out=out[d])
+    return out
 
 
 def rotate_coords_3d(coords, angle_x, angle_y, angle_z):
-    rot_matrix = np.identity(len(coords))
-    rot_matrix = create_matrix_rotation_x_3d(angle_x, rot_matrix)
-    rot_matrix = create_matrix_rotation_y_3d(angle_y, rot_matrix)
-    rot_matrix = create_matrix_rotation_z_3d(angle_z, rot_matrix)
-    coords = np.dot(coords.reshape(len(coords), -1).transpose(), rot_matrix).transpose().reshape(coords.shape)
-    return coords
+    rot_matrix = create_matrix_rotation_z_3d(angle_z,
+                                             create_matrix_rotation_y_3d(angle_y,
+                                                                         create_matrix_rotation_x_3d(angle_x)))
+    # coords are rotated with coords^T . rot_matrix, which is rot_matrix^T . coords when contracting the first axis
+    return np.tensordot(rot_matrix.T.astype(coords.dtype), coords, axes=1)
 
 
 def rotate_coords_2d(coords, angle):
     rot_matrix = create_matrix_rotation_2d(angle)
-    coords = np.dot(coords.reshape(len(coords), -1).transpose(), rot_matrix).transpose().reshape(coords.shape)
-    return coords
+    return np.tensordot(rot_matrix.T.astype(coords.dtype), coords, axes=1)
 
 
 def scale_coords(coords, scale):
-    return coords * scale
+    return (coords * scale).astype(coords.dtype, copy=False)
 
 
 def uncenter_coords(coords):
     shp = coords.shape[1:]
-    coords = deepcopy(coords)
-    for d in range(coords.shape[0]):
-        coords[d] += (shp[d] - 1) / 2.
+    return coords + ((np.array(shp, dtype=coords.dtype) - 1) / 2.).reshape((-1,) + (1,) * len(shp))
+
+
+def build_augmentation_coords(shape, rot_matrix=None, scale=1., alpha=0., sigma=1., dtype=np.float32):
+    """
+    Computes the coordinates for a combined rotation, scaling and elastic deformation of a patch of the given shape
+    in a single buffer. This gives the same as chaining create_zero_centered_coordinate_mesh, rotate_coords_3d/2d,
+    scale_coords, uncenter_coords and adding elastic offsets, but without allocating a new coordinate array in every
+    step. Use the result with interpolate_img so that the image is only interpolated once.
+
+    :param shape: patch shape (2d or 3d)
+    :param rot_matrix: n_dim x n_dim rotation matrix (see create_matrix_rotation_*), None for no rotation
+    :param scale: scaling factor applied together with the rotation
+    :param alpha: magnitude of the elastic deformation, 0 for no elastic deformation
+    :param sigma: smoothness (gaussian sigma) of the elastic deformation
+    :param dtype: dtype of the returned coordinates
+    :return: coordinates of shape (n_dim, *shape) in the voxel space of the patch (not zero centered)
+    """
+    n_dim = len(shape)
+    coords = create_zero_centered_coordinate_mesh(shape, dtype)
+    if rot_matrix is not None:
+        # same convention as rotate_coords_3d/2d
+        coords = np.tensordot((np.asarray(rot_matrix).T * scale).astype(dtype), coords, axes=1)
+    elif scale != 1:
+        coords *= scale
+    coords += ((np.array(shape, dtype=dtype) - 1) / 2.).reshape((-1,) + (1,) * n_dim)
+    if alpha != 0:
+        rand = generate_uniform_noise(coords.shape)
+        offsets = np.empty(shape, dtype=dtype)
+        for d in range(n_dim):
+            gaussian_filter(rand[d], sigma, output=offsets, mode="constant", cval=0)
+            offsets *= alpha
+            coords[d] += offsets
     return coords
 
 
@@ -99,77 +222,98 @@ def interpolate_img(img, coords, order=3, mode='nearest', cval=0.0, is_seg=False
         unique_labels = np.unique(img)
         result = np.zeros(coords.shape[1:], img.dtype)
         for i, c in enumerate(unique_labels):
-            res_new = map_coordinates((img == c).astype(float), coords, order=order, mode=mode, cval=cval)
+            res_new = map_coordinates((img == c).astype(np.float32), coords, order=order, mode=mode, cval=cval)
             result[res_new >= 0.5] = c
         return result
     else:
-        return map_coordinates(img.astype(float), coords, order=order, mode=mode, cval=cval).astype(img.dtype)
+        # float32 images are interpolated in float32, everything else as float64
+        tpe = img.dtype
+        if tpe not in (np.float32, np.float64):
+            img = img.astype(float)
+        return map_coordinates(img, coords, order=order, mode=mode, cval=cval).astype(tpe, copy=False)
 
 
-def generate_noise(shape, alpha, sigma):
-    noise = np.random.random(shape) * 2 - 1
-    noise = gaussian_filter(noise, sigma, mode="constant", cval=0) * alpha
+def generate_noise(shape, alpha, sigma, out=None):
+    """
+    Smoothed uniform noise.
+    :param out: optional array of the given shape to write the noise to (avoids allocating a new array per call)
+    :return:
+    """
+    noise = generate_uniform_noise(shape)
+    noise = gaussian_filter(noise, sigma, output=out, mode="constant", cval=0)
+    noise *= alpha
     return noise
 
 
 def find_entries_in_array(entries, myarray):
-    entries = np.array(entries)
-    values = np.arange(np.max(myarray) + 1)
-    lut = np.zeros(len(values), 'bool')
-    lut[entries.astype("int")] = True
-    return np.take(lut, myarray.astype(int))
+    # np.isin does not need a lookup table of size max(myarray) + 1 and does not cast myarray to int
+    return np.isin(myarray, np.asarray(entries))
+
+
+def get_center_crop_slices(img_shape, crop_size):
+    """
+    Slices for cropping crop_size out of the center of an image of shape img_shape. Only uses integer arithmetic, both
+    img_shape and crop_size must be sequences of ints of the same length.
+    """
+    return tuple(slice((s - c) // 2, (s - c) // 2 + c) for s, c in zip(img_shape, crop_size))
 
 
 def center_crop_3D_image(img, crop_size):
-    center = np.array(img.shape) / 2.
     if type(crop_size) not in (tuple, list):
         center_crop = [int(crop_size)] * len(img.shape)
     else:
         center_crop = crop_size
         assert len(center_crop) == len(
             img.shape), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (3d)"
-    return img[int(center[0] - center_crop[0] / 2.):int(center[0] + center_crop[0] / 2.),
-           int(center[1] - center_crop[1] / 2.):int(center[1] + center_crop[1] / 2.),
-           int(center[2] - center_crop[2] / 2.):int(center[2] + center_crop[2] / 2.)]
+    return img[get_center_crop_slices(img.shape, center_crop)]
 
 
 def center_crop_3D_image_batched(img, crop_size):
     # dim 0 is batch, dim 1 is channel, dim 2, 3 and 4 are x y z
-    center = np.array(img.shape[2:]) / 2.
     if type(crop_size) not in (tuple, list):
         center_crop = [int(crop_size)] * (len(img.shape) - 2)
     else:
         center_crop = crop_size
         assert len(center_crop) == (len(
             img.shape) - 2), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (3d)"
-    return img[:, :, int(center[0] - center_crop[0] / 2.):int(center[0] + center_crop[0] / 2.),
-           int(center[1] - center_crop[1] / 2.):int(center[1] + center_crop[1] / 2.),
-           int(center[2] - center_crop[2] / 2.):int(center[2] + center_crop[2] / 2.)]
+    return img[(slice(None), slice(None)) + get_center_crop_slices(img.shape[2:], center_crop)]
 
 
 def center_crop_2D_image(img, crop_size):
-    center = np.array(img.shape) / 2.
     if type(crop_size) not in (tuple, list):
         center_crop = [int(crop_size)] * len(img.shape)
     else:
         center_crop = crop_size
         assert len(center_crop) == len(
             img.shape), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (2d)"
-    return img[int(center[0] - center_crop[0] / 2.):int(center[0] + center_crop[0] / 2.),
-           int(center[1] - center_crop[1] / 2.):int(center[1] + center_crop[1] / 2.)]
+    return img[get_center_crop_slices(img.shape, center_crop)]
 
 
 def center_crop_2D_image_batched(img, crop_size):
     # dim 0 is batch, dim 1 is channel, dim 2 and 3 are x y
-    center = np.array(img.shape[2:]) / 2.
     if type(crop_size) not in (tuple, list):
         center_crop = [int(crop_size)] * (len(img.shape) - 2)
     else:
         center_crop = crop_size
         assert len(center_crop) == (len(
             img.shape) - 2), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (2d)"
-    return img[:, :, int(center[0] - center_crop[0] / 2.):int(center[0] + center_crop[0] / 2.),
-           int(center[1] - center_crop[1] / 2.):int(center[1] + center_crop[1] / 2.)]
+    return img[(slice(None), slice(None)) + get_center_crop_slices(img.shape[2:], center_crop)]
+
+
+def get_random_crop_lower_bounds(img_shape, crop_size):
+    """
+    Draws random lower bounds for cropping crop_size out of an image of shape img_shape (both without batch and color
+    channel axes). Axes where crop_size equals the image size always start at 0.
+    """
+    diffs = np.array(img_shape, dtype=int) - np.array(crop_size, dtype=int)
+    if np.any(diffs < 0):
+        raise ValueError("crop_size must be smaller or equal to the image size in all dimensions. "
+                         "crop_size: %s, image shape: %s" % (str(crop_size), str(img_shape)))
+    lbs = np.zeros(len(diffs), dtype=int)
+    mask = diffs > 0
+    if np.any(mask):
+        lbs[mask] = np.random.randint(0, diffs[mask])
+    return lbs
 
 
 def random_crop_3D_image(img, crop_size):
@@ -179,28 +323,8 @@ def random_crop_3D_image(img, crop_size):
         assert len(crop_size) == len(
             img.shape), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (3d)"
 
-    if crop_size[0] < img.shape[0]:
-        lb_x = np.random.randint(0, img.shape[0] - crop_size[0])
-    elif crop_size[0] == img.shape[0]:
-        lb_x = 0
-    else:
-        raise ValueError("crop_size[0] must be smaller or equal to the images x dimension")
-
-    if crop_size[1] < img.shape[1]:
-        lb_y = np.random.randint(0, img.shape[1] - crop_size[1])
-    elif crop_size[1] == img.shape[1]:
-        lb_y = 0
-    else:
-        raise ValueError("crop_size[1] must be smaller or equal to the images y dimension")
-
-    if crop_size[2] < img.shape[2]:
-        lb_z = np.random.randint(0, img.shape[2] - crop_size[2])
-    elif crop_size[2] == img.shape[2]:
-        lb_z = 0
-    else:
-        raise ValueError("crop_size[2] must be smaller or equal to the images z dimension")
-
-    return img[lb_x:lb_x + crop_size[0], lb_y:lb_y + crop_size[1], lb_z:lb_z + crop_size[2]]
+    lbs = get_random_crop_lower_bounds(img.shape, crop_size)
+    return img[tuple(slice(lb, lb + cs) for lb, cs in zip(lbs, crop_size))]
 
 
 def random_crop_3D_image_batched(img, crop_size):
@@ -210,28 +334,8 @@ def random_crop_3D_image_batched(img, crop_size):
         assert len(crop_size) == (len(
             img.shape) - 2), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (3d)"
 
-    if crop_size[0] < img.shape[2]:
-        lb_x = np.random.randint(0, img.shape[2] - crop_size[0])
-    elif crop_size[0] == img.shape[2]:
-        lb_x = 0
-    else:
-        raise ValueError("crop_size[0] must be smaller or equal to the images x dimension")
-
-    if crop_size[1] < img.shape[3]:
-        lb_y = np.random.randint(0, img.shape[3] - crop_size[1])
-    elif crop_size[1] == img.shape[3]:
-        lb_y = 0
-    else:
-        raise ValueError("crop_size[1] must be smaller or equal to the images y dimension")
-
-    if crop_size[2] < img.shape[4]:
-        lb_z = np.random.randint(0, img.shape[4] - crop_size[2])
-    elif crop_size[2] == img.shape[4]:
-        lb_z = 0
-    else:
-        raise ValueError("crop_size[2] must be smaller or equal to the images z dimension")
-
-    return img[:, :, lb_x:lb_x + crop_size[0], lb_y:lb_y + crop_size[1], lb_z:lb_z + crop_size[2]]
+    lbs = get_random_crop_lower_bounds(img.shape[2:], crop_size)
+    return img[(slice(None), slice(None)) + tuple(slice(lb, lb + cs) for lb, cs in zip(lbs, crop_size))]
 
 
 def random_crop_2D_image(img, crop_size):
@@ -241,21 +345,8 @@ def random_crop_2D_image(img, crop_size):
         assert len(crop_size) == len(
             img.shape), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (2d)"
 
-    if crop_size[0] < img.shape[0]:
-        lb_x = np.random.randint(0, img.shape[0] - crop_size[0])
-    elif crop_size[0] == img.shape[0]:
-        lb_x = 0
-    else:
-        raise ValueError("crop_size[0] must be smaller or equal to the images x dimension")
-
-    if crop_size[1] < img.shape[1]:
-        lb_y = np.random.randint(0, img.shape[1] - crop_size[1])
-    elif crop_size[1] == img.shape[1]:
-        lb_y = 0
-    else:
-        raise ValueError("crop_size[1] must be smaller or equal to the images y dimension")
-
-    return img[lb_x:lb_x + crop_size[0], lb_y:lb_y + crop_size[1]]
+    lbs = get_random_crop_lower_bounds(img.shape, crop_size)
+    return img[tuple(slice(lb, lb + cs) for lb, cs in zip(lbs, crop_size))]
 
 
 def random_crop_2D_image_batched(img, crop_size):
@@ -265,21 +356,8 @@ def random_crop_2D_image_batched(img, crop_size):
         assert len(crop_size) == (len(
             img.shape) - 2), "If you provide a list/tuple as center crop make sure it has the same len as your data has dims (2d)"
 
-    if crop_size[0] < img.shape[2]:
-        lb_x = np.random.randint(0, img.shape[2] - crop_size[0])
-    elif crop_size[0] == img.shape[2]:
-        lb_x = 0
-    else:
-        raise ValueError("crop_size[0] must be smaller or equal to the images x dimension")
-
-    if crop_size[1] < img.shape[3]:
-        lb_y = np.random.randint(0, img.shape[3] - crop_size[1])
-    elif crop_size[1] == img.shape[3]:
-        lb_y = 0
-    else:
-        raise ValueError("crop_size[1] must be smaller or equal to the images y dimension")
-
-    return img[:, :, lb_x:lb_x + crop_size[0], lb_y:lb_y + crop_size[1]]
+    lbs = get_random_crop_lower_bounds(img.shape[2:], crop_size)
+    return img[(slice(None), slice(None)) + tuple(slice(lb, lb + cs) for lb, cs in zip(lbs, crop_size))]
 
 
 def resize_image_by_padding(image, new_shape, pad_value=None):
@@ -292,45 +370,28 @@ def resize_image_by_padding(image, new_shape, pad_value=None):
             pad_value = image[0, 0, 0]
         else:
             raise ValueError("Image must be either 2 or 3 dimensional")
-    res = np.ones(list(new_shape), dtype=image.dtype) * pad_value
-    start = np.array(new_shape) / 2. - np.array(shape) / 2.
-    if len(shape) == 2:
-        res[int(start[0]):int(start[0]) + int(shape[0]), int(start[1]):int(start[1]) + int(shape[1])] = image
-    elif len(shape) == 3:
-        res[int(start[0]):int(start[0]) + int(shape[0]), int(start[1]):int(start[1]) + int(shape[1]),
-        int(start[2]):int(start[2]) + int(shape[2])] = image
-    return res
+    # np.pad only writes the border, the interior is copied from image once
+    pad_below = [int(new_shape[d] / 2. - shape[d] / 2.) for d in range(len(shape))]
+    pad_width = [(pad_below[d], new_shape[d] - shape[d] - pad_below[d]) for d in range(len(shape))]
+    return np.pad(image, pad_width, mode='constant', constant_values=pad_value)
 
 
 def resize_image_by_padding_batched(image, new_shape, pad_value=None):
     shape = tuple(list(image.shape[2:]))
     new_shape = tuple(np.max(np.concatenate((shape, new_shape)).reshape((2, len(shape))), axis=0))
-    if pad_value is None:
-        if len(shape) == 2:
-            pad_value = image[0, 0]
-        elif len(shape) == 3:
-            pad_value = image[0, 0, 0]
-        else:
-            raise ValueError("Image must be either 2 or 3 dimensional")
-    start = np.array(new_shape) / 2. - np.array(shape) / 2.
-    if len(shape) == 2:
-        res = np.ones((image.shape[0], image.shape[1], new_shape[0], new_shape[1]), dtype=image.dtype) * pad_value
-        res[:, :, int(start[0]):int(start[0]) + int(shape[0]), int(start[1]):int(start[1]) + int(shape[1])] = image[:,
-                                                                                                              :]
-    elif len(shape) == 3:
-        res = np.ones((image.shape[0], image.shape[1], new_shape[0], new_shape[1], new_shape[2]),
-                      dtype=image.dtype) * pad_value
-        res[:, :, int(start[0]):int(start[0]) + int(shape[0]), int(start[1]):int(start[1]) + int(shape[1]),
-        int(start[2]):int(start[2]) + int(shape[2])] = image[:, :]
-    else:
+    if len(shape) not in (2, 3):
         raise RuntimeError("unexpected dimension")
-    return res
+    if pad_value is None:
+        pad_value = image[(0,) * len(image.shape)]
+    pad_below = [int(new_shape[d] / 2. - shape[d] / 2.) for d in range(len(shape))]
+    pad_width = [(0, 0), (0, 0)] + [(pad_below[d], new_shape[d] - shape[d] - pad_below[d]) for d in range(len(shape))]
+    return np.pad(image, pad_width, mode='constant', constant_values=pad_value)
 
 
 def create_matrix_rotation_x_3d(angle, matrix=None):
     rotation_x = np.array([[1, 0, 0],
-                           [0, np.cos(angle), -np.sin(angle)],
-                           [0, np.sin(angle), np.cos(angle)]])
+                           [0, cos(angle), -sin(angle)],
+                           [0, sin(angle), cos(angle)]])
     if matrix is None:
         return rotation_x
 
@@ -338,9 +399,9 @@ def create_matrix_rotation_x_3d(angle, matrix=None):
 
 
 def create_matrix_rotation_y_3d(angle, matrix=None):
-    rotation_y = np.array([[np.cos(angle), 0, np.sin(angle)],
+    rotation_y = np.array([[cos(angle), 0, sin(angle)],
                            [0, 1, 0],
-                           [-np.sin(angle), 0, np.cos(angle)]])
+                           [-sin(angle), 0, cos(angle)]])
     if matrix is None:
         return rotation_y
 
@@ -348,8 +409,8 @@ def create_matrix_rotation_y_3d(angle, matrix=None):
 
 
 def create_matrix_rotation_z_3d(angle, matrix=None):
-    rotation_z = np.array([[np.cos(angle), -np.sin(angle), 0],
-                           [np.sin(angle), np.cos(angle), 0],
+    rotation_z = np.array([[cos(angle), -sin(angle), 0],
+                           [sin(angle), cos(angle), 0],
                            [0, 0, 1]])
     if matrix is None:
         return rotation_z
@@ -358,8 +419,8 @@ def create_matrix_rotation_z_3d(angle, matrix=None):
 
 
 def create_matrix_rotation_2d(angle, matrix=None):
-    rotation = np.array([[np.cos(angle), -np.sin(angle)],
-                         [np.sin(angle), np.cos(angle)]])
+    rotation = np.array([[cos(angle), -sin(angle)],
+                         [sin(angle), cos(angle)]])
     if matrix is None:
         return rotation
 
@@ -377,10 +438,8 @@ def illumination_jitter(img, u, s, sigma):
     # img must have shape [....., c] where c is the color channel
     alpha = np.random.normal(0, sigma, s.shape)
     jitter = np.dot(u, alpha * s)
-    img2 = np.array(img)
-    for c in range(img.shape[0]):
-        img2[c] = img[c] + jitter[c]
-    return img2
+    img = np.asarray(img)
+    return (img + jitter.reshape((-1,) + (1,) * (img.ndim - 1))).astype(img.dtype, copy=False)
 
 
 def general_cc_var_num_channels(img, diff_order=0, mink_norm=1, sigma=1, mask_im=None, saturation_threshold=255,
@@ -393,9 +452,8 @@ def general_cc_var_num_channels(img, diff_order=0, mink_norm=1, sigma=1, mask_im
     img_internal = np.array(img)
     if mask_im is None:
         mask_im = np.zeros(img_internal.shape[1:], dtype=bool)
-    img_dil = deepcopy(img_internal)
-    for c in range(img.shape[0]):
-        img_dil[c] = grey_dilation(img_internal[c], tuple([dilation_size] * dim_img))
+    # size 1 along the color channel: all channels are dilated separately in one call
+    img_dil = grey_dilation(img_internal, tuple([1] + [dilation_size] * dim_img))
     mask_im = mask_im | np.any(img_dil >= saturation_threshold, axis=0)
     if sigma != 0:
         mask_im[:sigma, :] = 1
@@ -406,7 +464,7 @@ def general_cc_var_num_channels(img, diff_order=0, mink_norm=1, sigma=1, mask_im
             mask_im[:, :, mask_im.shape[2] - sigma:] = 1
             mask_im[:, :, :sigma] = 1
 
-    output_img = deepcopy(img_internal)
+    output_img = img_internal.copy()
 
     if diff_order == 0 and sigma != 0:
         for c in range(img_internal.shape[0]):
@@ -442,6 +500,25 @@ def general_cc_var_num_channels(img, diff_order=0, mink_norm=1, sigma=1, mask_im
     return white_colors, output_img
 
 
+def label_connected_components(image):
+    """
+    Connected component labeling with face connectivity, same as scipy.ndimage.label with its default structure. Uses
+    cc3d (pip install connected-components-3d) if it is installed, which is faster than scipy. cc3d only handles up to 3
+    dimensions, so leading axes of size 1 are squeezed and scipy is used if that is not enough.
+    :param image: nd array, all nonzero voxels are foreground
+    :return: label map, number of components
+    """
+    if cc3d is not None:
+        squeezed = image
+        while squeezed.ndim > 3 and squeezed.shape[0] == 1:
+            squeezed = squeezed[0]
+        if squeezed.ndim in (2, 3):
+            labels, n_components = cc3d.connected_components(squeezed != 0, connectivity=4 if squeezed.ndim == 2 else 6,
+                                                             return_N=True)
+            return labels.reshape(image.shape), n_components
+    return lb(image)
+
+
 def convert_seg_to_bounding_box_coordinates(data_dict, dim, get_rois_from_seg_flag=False, class_specific_seg_flag=False):
 
         '''
@@ -473,23 +550,25 @@ def convert_seg_to_bounding_box_coordinates(data_dict, dim, get_rois_from_seg_fl
             p_roi_masks_list = []
             p_roi_labels_list = []
 
-            if np.sum(data_dict['seg'][b]!=0) > 0:
+            if np.any(data_dict['seg'][b]):
                 if get_rois_from_seg_flag:
-                    clusters, n_cands = lb(data_dict['seg'][b])
+                    clusters, n_cands = label_connected_components(data_dict['seg'][b])
                     data_dict['class_target'][b] = [data_dict['class_target'][b]] * n_cands
                 else:
                     n_cands = int(np.max(data_dict['seg'][b]))
-                    clusters = data_dict['seg'][b]
-
-                rois = np.array([(clusters == ii) * 1 for ii in range(1, n_cands + 1)])  # separate clusters and concat
-                for rix, r in enumerate(rois):
-                    if np.sum(r !=0) > 0: #check if the lesion survived data augmentation
-                        seg_ixs = np.argwhere(r != 0)
-                        coord_list = [np.min(seg_ixs[:, 1])-1, np.min(seg_ixs[:, 2])-1, np.max(seg_ixs[:, 1])+1,
-                                         np.max(seg_ixs[:, 2])+1]
+                    clusters = data_dict['seg'][b].astype(int)
+
+                # bounding box slices of all clusters in a single pass. Entries are None for clusters that did not
+                # survive data augmentation
+                roi_slices = find_objects(clusters, max_label=n_cands)
+                for rix, sl in enumerate(roi_slices):
+                    if sl is not None:
+                        r = np.zeros(clusters.shape, dtype='uint8')
+                        r[sl] = clusters[sl] == rix + 1
+                        # sl[0] is the channel axis
+                        coord_list = [sl[1].start - 1, sl[2].start - 1, sl[1].stop, sl[2].stop]
                         if dim == 3:
-
-                            coord_list.extend([np.min(seg_ixs[:, 3])-1, np.max(seg_ixs[:, 3])+1])
+                            coord_list.extend([sl[3].start - 1, sl[3].stop])
 
                         p_coords_list.append(coord_list)
                         p_roi_masks_list.append(r)
@@ -551,6 +630,7 @@ def resize_segmentation(segmentation, new_shape, order=3, cval=0):
     else:
         reshaped = np.zeros(new_shape, dtype=segmentation.dtype)
 
+        # one label at a time, see resize_multichannel_image for why this is not done in a single resize call
         for i, c in enumerate(unique_labels):
             reshaped_multihot = resize((segmentation == c).astype(float), new_shape, order, mode="edge", clip=True, anti_aliasing=False)
             reshaped[reshaped_multihot >= 0.5] = c
@@ -566,12 +646,13 @@ def resize_multichannel_image(multichannel_image, new_shape, order=3):
     :param order:
     :return:
     '''
-    tpe = multichannel_image.dtype
     new_shp = [multichannel_image.shape[0]] + list(new_shape)
     result = np.zeros(new_shp, dtype=multichannel_image.dtype)
+    # do not resize all channels in one call: skimage would also interpolate along the channel axis which is a lot
+    # slower (and not exact for order > 1)
     for i in range(multichannel_image.shape[0]):
         result[i] = resize(multichannel_image[i].astype(float), new_shape, order, "constant", 0, True, anti_aliasing=False)
-    return result.astype(tpe)
+    return result
 
 
 def get_range_val(value, rnd_type="uniform"):
@@ -0,0 +1,170 @@
+# Copyright 2017 Division of Medical Image Computing, German Cancer Research Center (DKFZ)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import unittest
+import numpy as np
+from batchgenerators.augmentations.utils import create_zero_centered_coordinate_mesh, rotate_coords_2d, \
+    rotate_coords_3d, create_matrix_rotation_x_3d, create_matrix_rotation_y_3d, create_matrix_rotation_z_3d, \
+    create_matrix_rotation_2d, build_augmentation_coords, scale_coords, uncenter_coords, elastic_deform_coordinates, \
+    random_crop_3D_image_batched, random_crop_2D_image, interpolate_img, interpolate_img_batched
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+class TestRotateCoords(unittest.TestCase):
+
+    def test_rotate_coords_3d(self):
+        coords = create_zero_centered_coordinate_mesh((10, 12, 14))
+        angle_x, angle_y, angle_z = 0.3, 1.2, -2.
+
+        rot_matrix = np.dot(np.dot(create_matrix_rotation_x_3d(angle_x), create_matrix_rotation_y_3d(angle_y)),
+                            create_matrix_rotation_z_3d(angle_z))
+        expected = np.dot(coords.reshape(3, -1).transpose(), rot_matrix).transpose().reshape(coords.shape)
+
+        rotated = rotate_coords_3d(coords, angle_x, angle_y, angle_z)
+
+        self.assertEqual(rotated.shape, coords.shape, "rotate_coords_3d changed the shape of coords")
+        self.assertTrue(np.allclose(rotated, expected, atol=1e-4),
+                        "rotate_coords_3d does not match the explicit rotation")
+
+    def test_rotate_coords_2d(self):
+        coords = create_zero_centered_coordinate_mesh((10, 12))
+        angle = 0.7
+
+        expected = np.dot(coords.reshape(2, -1).transpose(),
+                          create_matrix_rotation_2d(angle)).transpose().reshape(coords.shape)
+
+        rotated = rotate_coords_2d(coords, angle)
+
+        self.assertEqual(rotated.shape, coords.shape, "rotate_coords_2d changed the shape of coords")
+        self.assertTrue(np.allclose(rotated, expected, atol=1e-4),
+                        "rotate_coords_2d does not match the explicit rotation")
+
+
+class TestFloat32Coords(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+
+    def test_dtype_is_kept(self):
+        coords = create_zero_centered_coordinate_mesh((10, 12, 14))
+        coords = elastic_deform_coordinates(coords, 100., 5.)
+        coords = rotate_coords_3d(coords, 0.3, 1.2, -2.)
+        coords = scale_coords(coords, 1.1)
+        coords = uncenter_coords(coords)
+
+        self.assertEqual(coords.dtype, np.float32, "coordinate pipeline did not stay in float32")
+
+    def test_interpolate_order_3(self):
+        shape = (20, 24, 16)
+        img = np.random.random(shape).astype(np.float32)
+        coords = uncenter_coords(rotate_coords_3d(create_zero_centered_coordinate_mesh(shape), 0.3, 1.2, -2.))
+
+        res_32 = interpolate_img(img, coords, 3)
+        res_64 = interpolate_img(img.astype(float), coords.astype(float), 3)
+
+        self.assertEqual(res_32.dtype, np.float32, "float32 image must be interpolated to float32")
+        self.assertTrue(np.allclose(res_32, res_64, atol=1e-4), "float32 interpolation deviates from float64")
+
+
+class TestInterpolateImgBatched(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+        self.img = np.random.random((2, 3, 20, 22, 24)).astype(np.float32)
+        self.coords = np.stack([build_augmentation_coords((16, 18, 20), create_matrix_rotation_x_3d(0.4), 1.2, 50., 4.)
+                                for _ in range(2)]) + 2
+
+    def test_scipy(self):
+        res = interpolate_img_batched(self.img, self.coords, 3, 'nearest', backend='scipy')
+
+        self.assertEqual(res.shape, (2, 3, 16, 18, 20), "unexpected result shape")
+        for b in range(2):
+            for c in range(3):
+                self.assertTrue(np.array_equal(res[b, c], interpolate_img(self.img[b, c], self.coords[b], 3, 'nearest')),
+                                "interpolate_img_batched does not match interpolate_img")
+
+    @unittest.skipIf(torch is None, "pytorch is not installed")
+    def test_torch_matches_scipy(self):
+        for order in (0, 1):
+            for mode, cval in (('nearest', 0), ('constant', 0), ('constant', 2.5), ('mirror', 0)):
+                res_scipy = interpolate_img_batched(self.img, self.coords, order, mode, cval, backend='scipy')
+                res_torch = interpolate_img_batched(self.img, self.coords, order, mode, cval, backend='torch')
+
+                self.assertTrue(np.allclose(res_scipy, res_torch, atol=1e-4),
+                                "torch backend differs from scipy for order %d and mode %s" % (order, mode))
+
+
+class TestBuildAugmentationCoords(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+
+    def test_identity(self):
+        shape = (10, 12, 14)
+        coords = build_augmentation_coords(shape)
+
+        self.assertEqual(coords.dtype, np.float32, "unexpected dtype of coords")
+        self.assertTrue(np.allclose(coords, np.indices(shape)), "coords of an identity transform must be np.indices")
+
+    def test_rotation_and_scale_3d(self):
+        shape = (10, 12, 14)
+        rot_matrix = np.dot(np.dot(create_matrix_rotation_x_3d(0.3), create_matrix_rotation_y_3d(1.2)),
+                            create_matrix_rotation_z_3d(-2.))
+
+        expected = create_zero_centered_coordinate_mesh(shape, float)
+        expected = rotate_coords_3d(expected, 0.3, 1.2, -2.)
+        expected = uncenter_coords(scale_coords(expected, 0.8))
+
+        coords = build_augmentation_coords(shape, rot_matrix, 0.8, dtype=float)
+
+        self.assertTrue(np.allclose(coords, expected), "fused coords do not match the chained coordinate transforms")
+
+    def test_elastic_2d(self):
+        shape = (30, 32)
+
+        np.random.seed(1)
+        expected = elastic_deform_coordinates(np.indices(shape).astype(float), 100., 5.)
+        np.random.seed(1)
+        coords = build_augmentation_coords(shape, alpha=100., sigma=5., dtype=float)
+
+        self.assertTrue(np.allclose(coords, expected), "fused coords do not match elastic_deform_coordinates")
+
+
+class TestRandomCropImage(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1234)
+
+    def test_random_crop_3D_image_batched(self):
+        img = np.random.random((2, 3, 20, 30, 25))
+
+        cropped = random_crop_3D_image_batched(img, (10, 30, 5))
+
+        self.assertEqual(cropped.shape, (2, 3, 10, 30, 5), "unexpected crop shape")
+        self.assertTrue(any(np.array_equal(img[:, :, x:x + 10, :, z:z + 5], cropped)
+                            for x in range(11) for z in range(21)), "crop is not a contiguous part of the image")
+
+    def test_random_crop_2D_image_too_large(self):
+        img = np.random.random((20, 30))
+
+        self.assertRaises(ValueError, random_crop_2D_image, img, (21, 30))
+
+
+if __name__ == '__main__':
+    unittest.main()
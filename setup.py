@@ -10,7 +10,7 @@ setup(name='batchgenerators',
       packages=['batchgenerators', 'batchgenerators.augmentations',
       'batchgenerators.examples', 'batchgenerators.transforms', 'batchgenerators.dataloading'],
       install_requires=[
-            "numpy>=1.10.2",
+            "numpy>=1.17",
             "scipy",
             "scikit-image",
             "future",